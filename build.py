@@ -10,37 +10,320 @@
  -------------------------------------------------------------------------
 """
 
+import configparser
+import grp
+import hashlib
 import json
 import platform
+import pwd
 import re
-import tarfile
-from argparse import ArgumentParser
+import stat
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
-from os import getenv, symlink
+from fnmatch import fnmatch
+from functools import lru_cache
+from os import (
+    DirEntry,
+    cpu_count,
+    environ,
+    getenv,
+    link,
+    lstat,
+    readlink,
+    replace,
+    scandir,
+    symlink,
+    unlink,
+    walk,
+)
+from os.path import abspath, islink, join, lexists
 from pathlib import Path
-from shutil import copytree, ignore_patterns, which
-from subprocess import DEVNULL, PIPE, STDOUT, CompletedProcess
+from secrets import token_hex
+from shutil import copy2, copytree, ignore_patterns, which
+from subprocess import DEVNULL, PIPE, STDOUT, CompletedProcess, Popen
 from subprocess import check_output as check_subprocess_output
 from subprocess import run as run_subprocess
-from typing import Callable
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import tarfile  # only imported when packaging
 
-import lsb_release
+
+# Matches the versions set in swift/CMakeLists.txt
+VERSIONS_REGEX = re.compile(r'set\((SWIFT_VERSION|KLEPTO_VERSION)\s+"([^"]*)"\)')
 
 
 # Util functions
+print_lock = Lock()  # products can be built concurrently
+
+
+def log(message: str):
+    with print_lock:
+        print(message)
+
+
 def fail(message: str):
-    print(f"!!! {message}")
+    log(f"!!! {message}")
     exit(1)
 
 
 def run_command(command: list, *args, cwd=None, **kwargs) -> CompletedProcess:
-    print(
-        f">>> Running '{' '.join(command)}'{(' in ' + str(Path(cwd).absolute())) if cwd else ''}"
+    log(
+        f">>> Running '{' '.join(command)}'{(' in ' + abspath(cwd)) if cwd else ''}"
     )
     return run_subprocess(command, *args, cwd=cwd, **kwargs)
 
 
+def default_jobs() -> int:
+    # One job per core, but no more than one per 4GiB of available RAM
+    # since the LLVM and clang compile steps like to eat RAM too
+    cpus = cpu_count() or 1
+    try:
+        with open("/proc/meminfo", "r") as file:
+            result = re.search(
+                r"^MemAvailable:\s+(\d+) kB$", file.read(), flags=re.MULTILINE
+            )
+    except OSError:
+        return cpus
+
+    if not result:
+        return cpus
+
+    mem_kib = int(result.group(1))
+    return max(1, min(cpus, mem_kib // (4 * 1024 * 1024)))
+
+
+def positive_int(value: str) -> int:
+    # argparse type for --jobs
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number < 1:
+        raise ArgumentTypeError(f"expected a positive number, got '{value}'")
+
+    return number
+
+
+def preset_serializes_lto_links(preset: str) -> bool:
+    # Whether the preset or one of its mixins sets both
+    # llvm-max-parallel-lto-link-jobs=1 and swift-tools-max-parallel-lto-link-jobs=1
+    # in swift/utils/build-presets.ini
+    presets = configparser.RawConfigParser(allow_no_value=True, strict=False)
+    presets.optionxform = str
+    try:
+        presets.read("swift/utils/build-presets.ini")
+    except configparser.Error:
+        return False
+
+    options = {}
+
+    def _read_preset(name: str):
+        section = f"preset: {name}"
+        if not presets.has_section(section):
+            return
+
+        mixins = presets.get(section, "mixin-preset", fallback=None) or ""
+        for mixin in mixins.split():
+            _read_preset(mixin)
+
+        options.update(presets.items(section, raw=True))
+
+    _read_preset(preset)
+
+    return (
+        options.get("llvm-max-parallel-lto-link-jobs") == "1"
+        and options.get("swift-tools-max-parallel-lto-link-jobs") == "1"
+    )
+
+
+def write_json(path: Path, data):
+    # Write to a temporary file first so that a crash never leaves a half written file
+    temp_path = path.with_suffix(".json.tmp")
+    with open(temp_path, "w") as file:
+        json.dump(data, file, separators=(",", ":"), sort_keys=True)
+    replace(temp_path, path)
+
+
+def replace_and_copy(src: str, dst: str):
+    # copytree copy function: remove the destination first as it can be a hardlink
+    # to the source left by link_or_copy, which copy2 refuses to copy onto
+    if lexists(dst):
+        unlink(dst)
+
+    copy2(src, dst)
+
+
+def link_or_copy(src: str, dst: str):
+    # copytree copy function: hardlink the file and fall back to copying it
+    # if that's not possible (cross-device destdir, unsupported filesystem...)
+    # Symlinks are copied like copytree does, linking would link the symlink itself
+    if islink(src):
+        replace_and_copy(src, dst)
+        return
+
+    if lexists(dst):
+        unlink(dst)
+
+    try:
+        link(src, dst)
+    except OSError:
+        copy2(src, dst)
+
+
+def new_digest(fast: bool):
+    # xxh3 is a lot faster than blake2b but is an optional dependency, installing
+    # or removing it changes every hash so only use it for cheap to redo work
+    if fast:
+        try:
+            import xxhash
+
+            return xxhash.xxh3_128()
+        except ImportError:
+            pass
+
+    return hashlib.blake2b(digest_size=16)
+
+
+def fingerprint(
+    source_dirs: Tuple[str, ...],
+    context: dict,
+    ignore: Tuple[str, ...] = (),
+    fast: bool = False,
+) -> str:
+    # Only hashes paths, sizes and modification times, reading every source file
+    # would take about as long as building. Hidden folders (.git, .build...) and
+    # Python bytecode caches are skipped as building writes to them
+    digest = new_digest(fast)
+
+    for source_dir in source_dirs:
+        for dirpath, dirnames, filenames in walk(source_dir):
+            dirnames[:] = sorted(
+                name
+                for name in dirnames
+                if not name.startswith(".") and name != "__pycache__"
+            )
+            for filename in sorted(filenames):
+                if filename.endswith(".pyc"):
+                    continue
+
+                if any(fnmatch(filename, pattern) for pattern in ignore):
+                    continue
+
+                path = join(dirpath, filename)
+                stat_result = lstat(path)
+                digest.update(path.encode())
+                digest.update(stat_result.st_size.to_bytes(8, "little"))
+                digest.update(stat_result.st_mtime_ns.to_bytes(8, "little"))
+
+    digest.update(json.dumps(context, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def checkout_source_dirs() -> Optional[Tuple[str, ...]]:
+    # build-script and the SwiftPM bootstrap can use any checkout that
+    # update-checkout knows about, returns None if the list can't be read
+    config_file = Path("swift/utils/update_checkout/update-checkout-config.json")
+    try:
+        repos = json.loads(config_file.read_text())["repos"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    return tuple(sorted({"swift", *repos}))
+
+
+def scan_tree(path: str, arcname: str) -> Iterator[Tuple[str, DirEntry]]:
+    # Walks the tree in the same order as TarFile.add (sorted, parents first)
+    for entry in sorted(scandir(path), key=lambda entry: entry.name):
+        entry_arcname = f"{arcname}/{entry.name}"
+        yield entry_arcname, entry
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_tree(entry.path, entry_arcname)
+
+
+@lru_cache(maxsize=None)
+def user_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@lru_cache(maxsize=None)
+def group_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def add_tree_to_tar(tfile: "tarfile.TarFile", root: Path, arcname: str):
+    import tarfile
+
+    # Like TarFile.add, each entry is still lstat-ed, the gain comes from looking up
+    # owner and group names once per uid/gid instead of once per entry
+    tfile.add(root, arcname=arcname, recursive=False)
+
+    inodes = {}  # (device, inode) -> arcname, to store hardlinks only once
+    for entry_arcname, entry in scan_tree(str(root), arcname):
+        stat_result = entry.stat(follow_symlinks=False)
+
+        tarinfo = tarfile.TarInfo(entry_arcname)
+        tarinfo.mode = stat.S_IMODE(stat_result.st_mode)
+        tarinfo.uid = stat_result.st_uid
+        tarinfo.gid = stat_result.st_gid
+        tarinfo.uname = user_name(stat_result.st_uid)
+        tarinfo.gname = group_name(stat_result.st_gid)
+        tarinfo.mtime = stat_result.st_mtime
+
+        if entry.is_symlink():
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = readlink(entry.path)
+            tfile.addfile(tarinfo)
+        elif entry.is_dir(follow_symlinks=False):
+            tarinfo.type = tarfile.DIRTYPE
+            tfile.addfile(tarinfo)
+        elif entry.is_file(follow_symlinks=False):
+            inode = (stat_result.st_dev, stat_result.st_ino)
+            if stat_result.st_nlink > 1 and inode in inodes:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = inodes[inode]
+                tfile.addfile(tarinfo)
+                continue
+
+            inodes[inode] = entry_arcname
+            tarinfo.size = stat_result.st_size
+            with open(entry.path, "rb") as file:
+                tfile.addfile(tarinfo, file)
+        else:
+            # Let tarfile deal with special files
+            tfile.add(entry.path, arcname=entry_arcname, recursive=False)
+
+
+def read_os_release() -> dict:
+    # KEY=value lines, values can be quoted
+    # /usr/lib/os-release is the fallback if /etc/os-release does not exist
+    for path in ["/etc/os-release", "/usr/lib/os-release"]:
+        try:
+            with open(path, "r") as file:
+                lines = file.read().splitlines()
+        except FileNotFoundError:
+            continue
+
+        os_release = {}
+        for line in lines:
+            key, _, value = line.partition("=")
+            if value:
+                os_release[key] = value.strip("\"'")
+        return os_release
+
+    fail("Could not find /etc/os-release or /usr/lib/os-release")
+
+
 # Data classes
 class Configuration(Enum):
     RELEASE = "release"
@@ -59,12 +342,22 @@ class Product:
     #   icu_path: Path,
     #   versions_str: str,
     #   reconfigure: bool,
+    #   jobs: Optional[int],  # None if not given by the user
+    #   hardlinks: bool,
+    #   incremental: bool,
     # ) -> None
     build_and_install_func: Callable[
         [Path, Configuration, Path],
         None,
     ]
 
+    deps: Tuple[str, ...] = ()  # names of the products that must be built first
+
+    # Used to skip the product if it's unchanged, None to always build it
+    source_dirs: Optional[Tuple[str, ...]] = None
+    # Arguments that change how the product is installed
+    options: Tuple[str, ...] = ()
+
 
 # Products
 def build_toolchain(
@@ -74,23 +367,56 @@ def build_toolchain(
     icu_path: Path,
     versions_str: str,
     reconfigure: bool,  # unimplemented for toolchain
+    jobs: Optional[int],
+    hardlinks: bool,  # unused
+    incremental: bool,  # unused
 ):
     preset = {
         Configuration.RELEASE.value: "libnx_release",
         Configuration.DEBUG.value: "libnx_debug",
     }[configuration]
 
+    # Use a compiler cache if there is one, keyed on the compiler contents and
+    # relative to the current folder so that hits survive moving checkouts
+    launcher = which("ccache") or which("sccache")
+    launcher_args = (
+        [f"--cmake-c-launcher={launcher}", f"--cmake-cxx-launcher={launcher}"]
+        if launcher
+        else []
+    )
+    env = {
+        **environ,
+        "CCACHE_BASEDIR": str(Path.cwd()),
+        "CCACHE_COMPILERCHECK": "content",
+    }
+
+    # The LLVM and clang linking steps like to eat RAM. build-script only accepts
+    # preset options in preset mode so they can only be serialized by the preset,
+    # if it doesn't then default to one job for safety (unless given by the user)
+    if jobs is None:
+        if preset_serializes_lto_links(preset):
+            jobs = default_jobs()
+        else:
+            log(
+                f">>> Preset {preset} does not set llvm-max-parallel-lto-link-jobs=1 "
+                "and swift-tools-max-parallel-lto-link-jobs=1, building toolchain "
+                "with one job (use --jobs to override)"
+            )
+            jobs = 1
+
     result = run_command(
         [
             "python3",
             "./swift/utils/build-script",
-            "-j1",  # for safety, the LLVM and clang linking steps like to eat RAM
+            f"--jobs={jobs}",
+            *launcher_args,
             f"--preset={preset}",
-            f"devkitpro_path={devkitpro_path.absolute()}",
-            f"install_destdir={install_path.absolute()}",
-            f"libnx_icu_path={icu_path.absolute()}",
+            f"devkitpro_path={devkitpro_path}",
+            f"install_destdir={install_path}",
+            f"libnx_icu_path={icu_path}",
             f"versions_str=klepto-toolchain-{versions_str}",
-        ]
+        ],
+        env=env,
     )
     if result.returncode != 0:
         fail(f"Failed to build toolchain with preset {preset}")
@@ -103,26 +429,27 @@ def build_swiftpm(
     icu_path: Path,
     versions_str: str,
     reconfigure: bool,
+    jobs: Optional[int],  # unused
+    hardlinks: bool,  # unused
+    incremental: bool,  # unused
 ):
-    configuration_arg = {
-        Configuration.RELEASE.value: "--release",
-        Configuration.DEBUG.value: "",
-    }[configuration]
+    prefix = str(install_path)
 
     def _bootstrap(command: str):
-        return run_subprocess(
-            [
-                "python3",
-                "Utilities/bootstrap",
-                command,
-                "-v",
-                "--prefix",
-                install_path.absolute(),
-                "--reconfigure" if reconfigure else "",
-                configuration_arg,
-            ],
-            cwd="klepto-swiftpm",
-        )
+        bootstrap_command = [
+            "python3",
+            "Utilities/bootstrap",
+            command,
+            "-v",
+            "--prefix",
+            prefix,
+        ]
+        if reconfigure:
+            bootstrap_command.append("--reconfigure")
+        if configuration == Configuration.RELEASE.value:
+            bootstrap_command.append("--release")
+
+        return run_subprocess(bootstrap_command, cwd="klepto-swiftpm")
 
     if _bootstrap("build").returncode != 0:
         fail("Could not build swiftpm")
@@ -138,6 +465,9 @@ def build_icu(
     icu_path: Path,
     versions_str: str,
     reconfigure: bool,
+    jobs: Optional[int],  # unused
+    hardlinks: bool,
+    incremental: bool,
 ):
     # TODO: actually build it instead of asking users to manually build and place it
 
@@ -152,13 +482,54 @@ def build_icu(
     useful_folders = ["lib", "stubdata"]
     ignore_files = ["*.so.*", "*.so", "*.ao", "*.o", "*.d", "Makefile"]
 
+    # Skip copying if the files to copy did not change since the last time
+    hash_file = Path("build") / ".icu_src.hash"
+    source_hash = fingerprint(
+        tuple(str(libicu_path / folder) for folder in useful_folders),
+        {"install_path": str(install_path), "hardlinks": hardlinks},
+        ignore=tuple(ignore_files),
+        fast=True,
+    )
+    if (
+        incremental
+        and hash_file.exists()
+        and hash_file.read_text() == source_hash
+        and all((install_path / folder).exists() for folder in useful_folders)
+    ):
+        log(f">>> {libicu_path.absolute()} did not change since the last copy")
+        return
+
+    # Hardlink if possible, otherwise stream the folders through tar which is
+    # much faster than copytree for lots of small files
+    tar = which("tar")
+    same_device = libicu_path.stat().st_dev == install_path.stat().st_dev
+
     for folder in useful_folders:
-        copytree(
-            libicu_path / folder,
-            install_path / folder,
-            ignore=ignore_patterns(*ignore_files),
-            dirs_exist_ok=True,
+        if (hardlinks and same_device) or not tar:
+            copytree(
+                libicu_path / folder,
+                install_path / folder,
+                ignore=ignore_patterns(*ignore_files),
+                copy_function=link_or_copy if hardlinks else replace_and_copy,
+                dirs_exist_ok=True,
+            )
+            continue
+
+        exclude_args = [f"--exclude={pattern}" for pattern in ignore_files]
+        create_process = Popen(
+            [tar, *exclude_args, "-cf", "-", "-C", str(libicu_path), folder],
+            stdout=PIPE,
+        )
+        extract_process = Popen(
+            [tar, "-xf", "-", "-C", str(install_path)], stdin=create_process.stdout
         )
+        create_process.stdout.close()  # so that create gets SIGPIPE if extract fails
+
+        if extract_process.wait() != 0 or create_process.wait() != 0:
+            fail(f"Could not copy {libicu_path / folder} to {install_path}")
+
+    hash_file.parent.mkdir(parents=True, exist_ok=True)
+    hash_file.write_text(source_hash)
 
 
 def build_frontend(
@@ -168,10 +539,18 @@ def build_frontend(
     icu_path: Path,
     versions_str: str,
     reconfigure: bool,
+    jobs: Optional[int],  # unused
+    hardlinks: bool,
+    incremental: bool,  # unused
 ):
     # Install frontend
     frontend_path = Path("klepto-frontend")
-    copytree(frontend_path, install_path, dirs_exist_ok=True)
+    copytree(
+        frontend_path,
+        install_path,
+        copy_function=link_or_copy if hardlinks else replace_and_copy,
+        dirs_exist_ok=True,
+    )
 
     # Make ../klepto -> klepto-frontend symbolic link
     klepto_path = install_path.parent / "klepto"
@@ -180,11 +559,38 @@ def build_frontend(
     symlink(frontend_path / "klepto-frontend", klepto_path)
 
 
+# Products must be declared after their dependencies
+checkouts = checkout_source_dirs()
 products = [
-    Product("icu", "icu", build_icu),  # dependency of toolchain so build it first
-    Product("toolchain", "toolchain", build_toolchain),  # swift + clang
-    Product("swiftpm", "swiftpm", build_swiftpm),
-    Product("frontend", "klepto-frontend", build_frontend),
+    Product(
+        "icu",
+        "icu",
+        build_icu,
+        source_dirs=("libicuuc-libnx",),
+        options=("hardlinks",),
+    ),
+    Product(
+        "toolchain",  # swift + clang
+        "toolchain",
+        build_toolchain,
+        deps=("icu",),
+        source_dirs=checkouts,
+    ),
+    Product(
+        "swiftpm",
+        "swiftpm",
+        build_swiftpm,
+        deps=("toolchain",),
+        # llbuild, swift-driver, yams... are built along with swiftpm
+        source_dirs=("klepto-swiftpm", *checkouts) if checkouts is not None else None,
+    ),
+    Product(
+        "frontend",
+        "klepto-frontend",
+        build_frontend,
+        source_dirs=("klepto-frontend",),
+        options=("hardlinks",),
+    ),
 ]
 
 # Arguments parsing
@@ -221,7 +627,8 @@ parser.add_argument(
     "--package",
     action="store",
     help=(
-        "create a .tar.gz package of the installed products. "
+        "create a .tar.zst package of the installed products "
+        "(.tar.gz if the zstandard module is not installed). "
         "can optionnally give a location (default: ./dist) (cannot be used with any --only-* flag)"
     ),
     dest="package",
@@ -238,6 +645,20 @@ parser.add_argument(
     dest="dry_run",
 )
 
+parser.add_argument(
+    "--jobs",
+    "-j",
+    action="store",
+    type=positive_int,
+    help=(
+        "number of parallel build jobs (default: number of cores, limited by available RAM, "
+        "or 1 if the toolchain preset does not set llvm-max-parallel-lto-link-jobs=1 and "
+        "swift-tools-max-parallel-lto-link-jobs=1)"
+    ),
+    default=None,
+    dest="jobs",
+)
+
 parser.add_argument(
     "--no-reconfigure",
     action="store_false",
@@ -245,6 +666,20 @@ parser.add_argument(
     dest="reconfigure",
 )
 
+parser.add_argument(
+    "--no-incremental",
+    action="store_false",
+    help="build and install products even if their sources did not change since the last build",
+    dest="incremental",
+)
+
+parser.add_argument(
+    "--no-hardlinks",
+    action="store_false",
+    help="copy files instead of hardlinking them when installing icu and frontend",
+    dest="hardlinks",
+)
+
 args = parser.parse_args()
 
 # Arguments sanity check
@@ -263,11 +698,11 @@ for software in required_software:
 # Get devkitA64 and libnx versions from (dkp-)pacman
 using = "dkp-pacman"
 try:
-    query = run_command(["dkp-pacman", "-Qe"], stdout=PIPE)
+    query = run_command(["dkp-pacman", "-Qe"], stdout=PIPE, text=True).stdout
 except FileNotFoundError:
     try:
         using = "pacman"
-        query = check_subprocess_output(["pacman", "-Qe"])
+        query = check_subprocess_output(["pacman", "-Qe"], text=True)
     except FileNotFoundError:
         fail(
             "Could not find dkp-pacman or pacman to determine installed "
@@ -276,8 +711,13 @@ except FileNotFoundError:
 
 # entry format: "{package name} {version}"
 # entries are newline separated
-entries = query.stdout.decode().strip().split("\n")
-versions = dict(entry.split(" ") for entry in entries)
+# Only keep relevant versions (skip deko3d, devkita64-cmake, devkitA64-gdb...)
+relevant_packages = {"libnx", "devkitA64"}
+versions = {}
+for entry in query.splitlines():
+    package, _, version = entry.partition(" ")
+    if package in relevant_packages:
+        versions[package] = version
 
 # Ensure devkitA64 and libnx are installed
 if "devkitA64" not in versions:
@@ -291,34 +731,31 @@ swift_cmakelists = Path("swift/CMakeLists.txt")
 if not swift_cmakelists.exists():
     fail(f"Did not find swift source code at {swift_cmakelists.absolute()}")
 
-with open(swift_cmakelists, "r") as file:
-    result = re.search(r'set\(SWIFT_VERSION "(.*?)"\)', file.read())
-    if not result:
-        fail(f"Unable to parse SWIFT_VERSION from {swift_cmakelists.absolute()}")
-    swift_version = result.group(1)
+# Reversed so that the first occurrence of each variable wins
+found_versions = dict(reversed(VERSIONS_REGEX.findall(swift_cmakelists.read_text())))
 
-with open(swift_cmakelists, "r") as file:
-    result = re.search(r'set\(KLEPTO_VERSION "(.*?)"\)', file.read())
-    if not result:
-        fail(f"Unable to parse KLEPTO_VERSION from {swift_cmakelists.absolute()}")
-    klepto_version = result.group(1)
+for variable in ["SWIFT_VERSION", "KLEPTO_VERSION"]:
+    if variable not in found_versions:
+        fail(f"Unable to parse {variable} from {swift_cmakelists.absolute()}")
+
+swift_version = found_versions["SWIFT_VERSION"]
+klepto_version = found_versions["KLEPTO_VERSION"]
 
 
 # Check for devkitpro and icu
-icu_path = Path("libicuuc-libnx")
+# Paths given to the products are made absolute once and for all here
+icu_path = Path("libicuuc-libnx").absolute()
 if not icu_path.exists():
-    fail(
-        f"Directory {icu_path.absolute()} was not found, please build libicuuc and place it there"
-    )
+    fail(f"Directory {icu_path} was not found, please build libicuuc and place it there")
 
 devkitpro_path = getenv("DEVKITPRO")
 if not devkitpro_path:
     fail("DEVKITPRO environment variable is not set, cannot continue")
 
-devkitpro_path = Path(devkitpro_path)
+devkitpro_path = Path(devkitpro_path).absolute()
 if not devkitpro_path.exists():
     fail(
-        f"Directory {devkitpro_path.absolute()} was not found, please check the DEVKITPRO environment variable"
+        f"Directory {devkitpro_path} was not found, please check the DEVKITPRO environment variable"
     )
 
 versions_str = (
@@ -327,7 +764,10 @@ versions_str = (
 
 # Prepare build
 configuration = args.configuration
-platform_string = f"{lsb_release.get_distro_information()['ID'].lower()}{lsb_release.get_distro_information()['RELEASE']}-{platform.processor()}"
+os_release = read_os_release()
+if "ID" not in os_release:
+    fail("Could not find the distribution ID in os-release")
+platform_string = f"{os_release['ID'].lower()}{os_release.get('VERSION_ID', '')}-{platform.machine()}"
 dist_name = f"klepto-{klepto_version}-{configuration.upper()}-{platform_string}"
 
 install_destdir = args.install_destdir
@@ -336,6 +776,8 @@ if not install_destdir:
 else:
     install_destdir = Path(install_destdir)
 
+install_destdir = install_destdir.absolute()
+
 products_to_build = []
 
 for product in products:
@@ -345,17 +787,66 @@ for product in products:
 products_to_build = products_to_build or products
 
 print(
-    f">>> Prepared build for {', '.join([product.name for product in products_to_build])} in {install_destdir.absolute()}"
+    f">>> Prepared build for {', '.join([product.name for product in products_to_build])} in {install_destdir}"
 )
 
 # Build and install all products
 install_destdir.mkdir(parents=True, exist_ok=True)
 
-for product in products_to_build:
+
+# Fingerprints of the last successful build of each product
+product_hashes_file = Path("build") / ".product_hashes.json"
+product_hashes_lock = Lock()
+
+try:
+    product_hashes = json.loads(product_hashes_file.read_text())
+except (OSError, ValueError):
+    product_hashes = {}
+
+
+def build_product(
+    product: Product,
+    dependencies: List[Future],
+    installed_dependency_hashes: List[Optional[str]],
+) -> str:
+    # Wait for dependencies to be built and installed first, the ones that are not
+    # being built come with the hashes stored when they were last installed
+    dependency_hashes = [dependency.result() for dependency in dependencies]
+    dependency_hashes += installed_dependency_hashes
+
     product_destdir = install_destdir / product.install_path
+
+    if product.source_dirs is None:
+        # Unknown sources, use a random hash so that dependents get rebuilt too
+        product_hash = token_hex(16)
+    else:
+        product_hash = fingerprint(
+            product.source_dirs,
+            {
+                "configuration": configuration,
+                "devkitpro_path": str(devkitpro_path),
+                "icu_path": str(icu_path),
+                "versions_str": versions_str,
+                "install_path": str(product_destdir),
+                "dependencies": dependency_hashes,
+                "options": {
+                    option: getattr(args, option) for option in product.options
+                },
+            },
+        )
+
+    if (
+        args.incremental
+        and product_hashes.get(product.name) == product_hash
+        and product_destdir.exists()
+        and any(product_destdir.iterdir())
+    ):
+        log(f">>> {product.name} is up to date in {product_destdir}")
+        return product_hash
+
     product_destdir.mkdir(parents=True, exist_ok=True)
 
-    print(f">>> Building and installing {product.name} in {product_destdir.absolute()}")
+    log(f">>> Building and installing {product.name} in {product_destdir}")
 
     if not args.dry_run:
         product.build_and_install_func(
@@ -365,44 +856,97 @@ for product in products_to_build:
             icu_path,
             versions_str,
             args.reconfigure,
+            args.jobs,
+            args.hardlinks,
+            args.incremental,
         )
 
+        with product_hashes_lock:
+            product_hashes[product.name] = product_hash
+            product_hashes_file.parent.mkdir(parents=True, exist_ok=True)
+            write_json(product_hashes_file, product_hashes)
+
+    return product_hash
+
+
+# Products that are independent from each other are built concurrently,
+# dependencies that are not being built are assumed to be already installed
+with ThreadPoolExecutor(max_workers=len(products_to_build)) as executor:
+    futures = {}
+    for product in products_to_build:
+        dependencies = [futures[dep] for dep in product.deps if dep in futures]
+        with product_hashes_lock:
+            installed_dependency_hashes = [
+                product_hashes.get(dep) for dep in product.deps if dep not in futures
+            ]
+        futures[product.name] = executor.submit(
+            build_product, product, dependencies, installed_dependency_hashes
+        )
+
+    for future in futures.values():
+        future.result()
+
 # Build manifest
 manifest_file = install_destdir / "manifest.json"
 
-print(f">>> Writing manifest to {manifest_file.absolute()}")
-
-# Filter out irrelevant versions (deko3d, devkita64-cmake, devkitA64-gdb...)
-relevant_packages = ["libnx", "devkitA64"]
-versions = {
-    package: version
-    for package, version in versions.items()
-    if package in relevant_packages
-}
+print(f">>> Writing manifest to {manifest_file}")
 
 # Add swift and klepto
 versions["swift"] = swift_version
 versions["klepto"] = klepto_version
 
-with open(manifest_file, "w") as f:
-    manifest = {
-        "versions": versions,
-    }
-    f.write(json.dumps(manifest))
+manifest = {
+    "versions": versions,
+}
+write_json(manifest_file, manifest)
 
 print(
-    f">>> Done building {', '.join([product.name for product in products_to_build])} in {install_destdir.absolute()}"
+    f">>> Done building {', '.join([product.name for product in products_to_build])} in {install_destdir}"
 )
 
 # Package if requested
 if args.package:
-    package_file = Path(args.package) / f"{dist_name}.tar.gz"
+    # Only imported when packaging as they take a while to import
+    import tarfile
+
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None  # packages are compressed with gzip instead
+
+    # Prefer zstd, then parallel gzip using pigz, then Python's single threaded gzip
+    pigz = which("pigz")
+    extension = "tar.zst" if zstandard else "tar.gz"
+    package_file = Path(args.package) / f"{dist_name}.{extension}"
 
     package_file.parent.mkdir(exist_ok=True, parents=True)
 
     print(f">>> Writing {str(package_file.absolute())}")
 
-    with tarfile.open(package_file, mode="w:gz") as tfile:
-        tfile.add(install_destdir, arcname=dist_name)
+    def write_tar(fileobj, mode: str = "w|"):
+        with tarfile.open(fileobj=fileobj, mode=mode) as tfile:
+            add_tree_to_tar(tfile, install_destdir, dist_name)
+
+    # Compression needs little RAM so use every core, unlike the build jobs
+    with open(package_file, "wb") as file:
+        if zstandard:
+            compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+            with compressor.stream_writer(file) as compressed_file:
+                write_tar(compressed_file)
+        elif pigz:
+            pigz_process = Popen(
+                [pigz, "-p", str(cpu_count() or 1)], stdin=PIPE, stdout=file
+            )
+            try:
+                write_tar(pigz_process.stdin)
+                pigz_process.stdin.close()
+                broken_pipe = False
+            except BrokenPipeError:
+                broken_pipe = True  # pigz exited early
+
+            if pigz_process.wait() != 0 or broken_pipe:
+                fail(f"Failed to compress {package_file.absolute()} with pigz")
+        else:
+            write_tar(file, mode="w:gz")
 
     print(f">>> Done writing {str(package_file.absolute())}")